@@ -1,8 +1,14 @@
 from __future__ import print_function
 
 import argparse
+import concurrent.futures
 import errno
+import fnmatch
+import functools
+import hashlib
+import itertools
 import os
+import shlex
 import shutil
 import subprocess
 import sys
@@ -31,8 +37,9 @@ MACOS_BUILD_ARCHS = [
     'x64'
 ]
 
-def build_gn_args(platform_args):
-    return "--args='" + ' '.join(GN_COMMON_ARGS + platform_args) + "'"
+def build_gn_args(platform_args, extra_args=None):
+    # Rendered into each out dir's args.gn, which gn reads directly
+    return '\n'.join(GN_COMMON_ARGS + platform_args + (extra_args or [])) + '\n'
 
 GN_COMMON_ARGS = [
     # Xcode 12 Clang consider warning as error by default 
@@ -57,31 +64,110 @@ _GN_IOS_ARGS = [
     'use_xcode_clang=true',
     'target_environment="%s"'
 ]
-GN_IOS_ARGS = build_gn_args(_GN_APPLE_COMMON + _GN_IOS_ARGS)
+GN_IOS_ARGS = _GN_APPLE_COMMON + _GN_IOS_ARGS
 
 _GN_MACOS_ARGS = [
     'target_os="mac"',
     'use_xcode_clang=false'
 ]
-GN_MACOS_ARGS = build_gn_args(_GN_APPLE_COMMON + _GN_MACOS_ARGS)
+GN_MACOS_ARGS = _GN_APPLE_COMMON + _GN_MACOS_ARGS
 
-_GN_ANDROID_ARGS = [
+GN_ANDROID_ARGS = [
     'target_os="android"'
 ]
-GN_ANDROID_ARGS = build_gn_args(_GN_ANDROID_ARGS)
 
 
 # Utilities
 
+def _cmd_argv(cmd):
+    # Commands run without a shell; accept a pre-split argv or split a
+    # plain string the way a shell would
+    return shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+
 def sh(cmd, env=None, cwd=None):
-    print('Running cmd: %s' % cmd)
+    argv = _cmd_argv(cmd)
+    print('Running cmd: %s' % ' '.join(argv))
     try:
-        subprocess.check_call(cmd, env=env, cwd=cwd, shell=True, stdin=sys.stdin, stdout=sys.stdout, stderr=subprocess.STDOUT)
+        subprocess.check_call(argv, env=env, cwd=cwd, stdin=sys.stdin, stdout=sys.stdout, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
         sys.exit(e.returncode)
     except KeyboardInterrupt:
         pass
 
+def sh_capture(cmd, env=None, cwd=None):
+    argv = _cmd_argv(cmd)
+    print('Running cmd: %s' % ' '.join(argv))
+    result = subprocess.run(argv, env=env, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    sys.stdout.write(result.stdout.decode('utf-8', 'replace'))
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, argv)
+
+def sh_parallel(cmds, env=None, cwd=None, max_workers=None):
+    if max_workers is None:
+        max_workers = len(cmds)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(sh_capture, cmd, env, cwd) for cmd in cmds]
+        for future in futures:
+            try:
+                future.result()
+            except subprocess.CalledProcessError as e:
+                sys.exit(e.returncode)
+
+@functools.lru_cache(maxsize=None)
+def _tar_cmd():
+    # Deterministic archives need GNU tar's --sort/--mtime/--owner flags;
+    # macOS ships BSD tar, so prefer gtar (GNU tar from Homebrew) and only
+    # add the flags when the tar we found is actually GNU
+    tar_bin = 'gtar' if shutil.which('gtar') else 'tar'
+    try:
+        is_gnu = b'GNU tar' in subprocess.check_output([tar_bin, '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        is_gnu = False
+    cmd = (tar_bin,)
+    if is_gnu:
+        cmd += ('--sort=name', '--mtime=@0', '--owner=0', '--group=0', '--numeric-owner')
+    return cmd
+
+def tar_czf(archive, sources, cwd=None):
+    # pigz compresses on all cores and produces standard gzip output, so the
+    # .tgz name (and its consumers, e.g. the npm postinstall step) stay valid;
+    # fall back to single-threaded gzip when it is not installed. Sorted
+    # entries, zeroed ownership/mtimes and -n (no gzip header timestamp)
+    # make identical inputs produce byte-identical archives, which is what
+    # lets the artifact cache and any downstream dedup actually hit.
+    # Globs are expanded here since nothing runs through a shell anymore.
+    names = []
+    for pattern in sources:
+        if any(ch in pattern for ch in '*?['):
+            names += sorted(fnmatch.filter(os.listdir(cwd or '.'), pattern))
+        else:
+            names.append(pattern)
+    tar_cmd = list(_tar_cmd()) + ['-cf', '-'] + names
+    if shutil.which('pigz'):
+        gzip_cmd = ['pigz', '-n', '-p', str(os.cpu_count())]
+    else:
+        gzip_cmd = ['gzip', '-n']
+    print('Running cmd: %s | %s > %s' % (' '.join(tar_cmd), ' '.join(gzip_cmd), archive))
+    archive_path = os.path.join(cwd, archive) if cwd else archive
+    with open(archive_path, 'wb') as out:
+        tar = subprocess.Popen(tar_cmd, cwd=cwd, stdout=subprocess.PIPE)
+        gz = subprocess.Popen(gzip_cmd, stdin=tar.stdout, stdout=out)
+        tar.stdout.close()
+        if tar.wait() != 0 or gz.wait() != 0:
+            sys.exit(1)
+
+def link_or_copy(src, dst):
+    # Hardlink is O(1) and avoids pulling GB-scale artifacts through a
+    # userspace copy loop; fall back to a plain copy across filesystems
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.exists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
 def mkdirp(path):
     try:
         os.makedirs(path)
@@ -89,40 +175,155 @@ def mkdirp(path):
         if e.errno != errno.EEXIST:
             raise
 
+def _gclient_sync(sync_cmd, gclient_root, env, force=False):
+    # Hash the inputs that govern what gclient sync would do and skip the
+    # full DEPS-tree walk when nothing changed since the last successful run
+    h = hashlib.sha256(sync_cmd.encode('utf-8'))
+    for name in ('.gclient', os.path.join('src', 'DEPS')):
+        path = os.path.join(gclient_root, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    digest = h.hexdigest()
+    stamp_path = os.path.join(gclient_root, '.last_sync')
+    entries_path = os.path.join(gclient_root, '.gclient_entries')
+    if not force and os.path.isfile(stamp_path) and os.path.isfile(entries_path):
+        with open(stamp_path) as f:
+            if f.read().strip() == digest:
+                print('Skipping gclient sync, DEPS unchanged (use --force-sync to override)')
+                return
+    sh(sync_cmd, env, cwd=gclient_root)
+    with open(stamp_path, 'w') as f:
+        f.write(digest)
+
+def _cache_root():
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(xdg_cache_home, 'build-webrtc')
+
+ARTIFACT_CACHE_LIMIT = 50 * 1024 ** 3
+
+def _evict_artifact_cache(limit=ARTIFACT_CACHE_LIMIT):
+    # Drop least-recently-used artifact sets once the cache outgrows the limit
+    artifacts_root = os.path.join(_cache_root(), 'artifacts')
+    if not os.path.isdir(artifacts_root):
+        return
+    entries = []
+    total = 0
+    for name in os.listdir(artifacts_root):
+        path = os.path.join(artifacts_root, name)
+        if os.path.isdir(path):
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        else:
+            size = os.path.getsize(path)
+        entries.append((os.path.getmtime(path), path, size))
+        total += size
+    entries.sort()
+    for mtime, path, size in entries:
+        if total <= limit:
+            break
+        rmr(path)
+        total -= size
+
+@functools.lru_cache(maxsize=None)
+def _make_env(target_dir, platform):
+    depot_tools_dir = os.path.join(target_dir, 'depot_tools')
+    webrtc_dir = os.path.join(target_dir, 'webrtc', platform, 'src')
+    env = os.environ.copy()
+    path_parts = [env['PATH'], depot_tools_dir]
+    if platform == 'android':
+        # Same as . build/android/envsetup.sh
+        android_sdk_root = os.path.join(webrtc_dir, 'third_party/android_sdk/public')
+        path_parts.append(os.path.join(android_sdk_root, 'platform-tools'))
+        path_parts.append(os.path.join(android_sdk_root, 'tools'))
+        path_parts.append(os.path.join(webrtc_dir, 'build/android'))
+    env['PATH'] = os.pathsep.join(path_parts)
+    return env
+
+_rmr_seq = itertools.count()
+
 def rmr(path):
+    # Rename the tree out of the way so the path is immediately reusable,
+    # then delete it with rm -rf in a detached background process; rm's
+    # unlinkat loop beats shutil.rmtree's per-entry Python round trips and
+    # the build does not wait for it at all
+    if not os.path.lexists(path):
+        return
+    doomed = '%s.old.%d.%d' % (path, os.getpid(), next(_rmr_seq))
     try:
-        shutil.rmtree(path)
-    except OSError as e:
-        if e.errno != errno.ENOENT:
-            raise
+        os.rename(path, doomed)
+    except OSError:
+        # Rename failed (e.g. permissions); fall back to deleting in place,
+        # synchronously, since callers recreate the path right away
+        try:
+            subprocess.run(['rm', '-rf', path], check=True)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(path, ignore_errors=True)
+        return
+    try:
+        subprocess.Popen(['rm', '-rf', doomed], stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
+    except OSError:
+        shutil.rmtree(doomed, ignore_errors=True)
 
 
 # The Real Deal
 
-def setup(target_dir, platform):
+def setup(target_dir, platform, shallow=True, use_cache=True, force_sync=False):
     mkdirp(target_dir)
     os.chdir(target_dir)
 
     # Maybe fetch depot_tools
     depot_tools_dir = os.path.join(target_dir, 'depot_tools')
     if not os.path.isdir(depot_tools_dir):
-        print('Fetching Chromium depot_tools...')
-        sh('git clone https://chromium.googlesource.com/chromium/tools/depot_tools.git')
-
-    # Prepare environment
-    env = os.environ.copy()
-    env['PATH'] = '%s:%s' % (env['PATH'], depot_tools_dir)
+        clone_cmd = ['git', 'clone']
+        if shallow:
+            clone_cmd += ['--depth', '1', '--single-branch', '--branch', 'main']
+        clone_cmd.append('https://chromium.googlesource.com/chromium/tools/depot_tools.git')
+        if use_cache:
+            cached_depot_tools_dir = os.path.join(_cache_root(), 'depot_tools')
+            if not os.path.isdir(os.path.join(cached_depot_tools_dir, '.git')):
+                print('Fetching Chromium depot_tools into cache...')
+                mkdirp(_cache_root())
+                sh(clone_cmd + [cached_depot_tools_dir])
+            os.symlink(cached_depot_tools_dir, depot_tools_dir)
+        else:
+            print('Fetching Chromium depot_tools...')
+            sh(clone_cmd)
+
+    # Prepare environment (copied, the memoized dict must stay pristine)
+    env = dict(_make_env(target_dir, platform))
+    if shallow:
+        # A shallow depot_tools cannot self-update
+        env['DEPOT_TOOLS_UPDATE'] = '0'
 
     # Maybe fetch WebRTC
     webrtc_dir = os.path.join(target_dir, 'webrtc', platform)
+    fetch_spec = 'webrtc_%s' % platform
+    cache_key = hashlib.sha256(fetch_spec.encode('utf-8')).hexdigest()[:12]
+    cached_webrtc_dir = os.path.join(_cache_root(), 'webrtc-%s-%s' % (platform, cache_key))
     if not os.path.isdir(webrtc_dir):
-        mkdirp(webrtc_dir)
-        os.chdir(webrtc_dir)
-        print('Fetching WebRTC for %s...' % platform)
-        sh('fetch --nohooks webrtc_%s' % platform, env)
+        if use_cache and os.path.isdir(os.path.join(cached_webrtc_dir, 'src')):
+            # Hardlink the cached tree into place; gclient only rewrites
+            # files that actually change
+            print('Linking cached WebRTC for %s...' % platform)
+            mkdirp(os.path.dirname(webrtc_dir))
+            sh(['cp', '-Rl', cached_webrtc_dir, webrtc_dir])
+        else:
+            mkdirp(webrtc_dir)
+            os.chdir(webrtc_dir)
+            print('Fetching WebRTC for %s...' % platform)
+            fetch_cmd = ['fetch', '--nohooks']
+            if shallow:
+                fetch_cmd.append('--no-history')
+            sh(fetch_cmd + [fetch_spec], env)
+            if use_cache:
+                print('Populating WebRTC cache for %s...' % platform)
+                mkdirp(_cache_root())
+                sh(['cp', '-Rl', webrtc_dir, cached_webrtc_dir])
+    os.chdir(webrtc_dir)
 
     # Run gclient
-    sh('gclient sync', env)
+    _gclient_sync('gclient sync', webrtc_dir, env, force=force_sync)
 
     # Install dependencies
     if platform == 'android':
@@ -131,9 +332,7 @@ def setup(target_dir, platform):
         sh('./build/install-build-deps.sh')
 
 
-def sync(target_dir, platform):
-    build_dir = os.path.join(target_dir, 'build', platform)
-    depot_tools_dir = os.path.join(target_dir, 'depot_tools')
+def sync(target_dir, platform, force_sync=False):
     webrtc_dir = os.path.join(target_dir, 'webrtc', platform, 'src')
 
     if not os.path.isdir(webrtc_dir):
@@ -141,154 +340,271 @@ def sync(target_dir, platform):
         sys.exit(1)
 
     # Prepare environment
-    env = os.environ.copy()
-    path_parts = [env['PATH'], depot_tools_dir]
-    if platform == 'android':
-        # Same as . build/android/envsetup.sh
-        android_sdk_root = os.path.join(webrtc_dir, 'third_party/android_sdk/public')
-        path_parts.append(os.path.join(android_sdk_root, 'platform-tools'))
-        path_parts.append(os.path.join(android_sdk_root, 'tools'))
-        path_parts.append(os.path.join(webrtc_dir, 'build/android'))
-    env['PATH'] = ':'.join(path_parts)
+    env = _make_env(target_dir, platform)
 
     os.chdir(webrtc_dir)
 
-    sh('gclient sync -D', env)
+    _gclient_sync('gclient sync -D', os.path.dirname(webrtc_dir), env, force=force_sync)
 
 
-def build(target_dir, platform, debug):
+def build(target_dir, platform, debug, clean=False, reconfig=False, use_ccache=True, use_cache=True):
     build_dir = os.path.join(target_dir, 'build', platform)
     build_type = 'Debug' if debug else 'Release'
-    depot_tools_dir = os.path.join(target_dir, 'depot_tools')
     webrtc_dir = os.path.join(target_dir, 'webrtc', platform, 'src')
 
     if not os.path.isdir(webrtc_dir):
         print('WebRTC source not found, did you forget to run --setup?')
         sys.exit(1)
 
-    # Prepare environment
-    env = os.environ.copy()
-    path_parts = [env['PATH'], depot_tools_dir]
-    if platform == 'android':
-        # Same as . build/android/envsetup.sh
-        android_sdk_root = os.path.join(webrtc_dir, 'third_party/android_sdk/public')
-        path_parts.append(os.path.join(android_sdk_root, 'platform-tools'))
-        path_parts.append(os.path.join(android_sdk_root, 'tools'))
-        path_parts.append(os.path.join(webrtc_dir, 'build/android'))
-    env['PATH'] = ':'.join(path_parts)
+    # Prepare environment (copied, the memoized dict must stay pristine)
+    env = dict(_make_env(target_dir, platform))
 
     os.chdir(webrtc_dir)
 
-    # Cleanup old build
-    rmr('out')
-
-    # Run GN
+    # Let ninja compute the minimal rebuild set from the previous out dir;
+    # gn gen is safe to re-run against it. --clean forces a cold build.
+    if clean:
+        rmr('out')
+
+    # Wrap the compilers with sccache when available; WebRTC's platform
+    # independent TUs then recompile as cache hits across builds and
+    # target dirs
+    extra_gn_args = []
+    if use_ccache and shutil.which('sccache'):
+        extra_gn_args.append('cc_wrapper="sccache"')
+        env['SCCACHE_DIR'] = os.path.join(_cache_root(), 'sccache')
+        env.setdefault('SCCACHE_CACHE_SIZE', '50G')
+
+    # Whole-artifact cache: the same source revision, gn args and build type
+    # produce the same tarballs, so a repeat build is just a link from the
+    # cache. --clean and --no-cache both force a real build.
     if platform == 'ios':
-        for item in IOS_BUILD_ARCHS:
-            tenv, arch = item.split(':')
-            gn_out_dir = 'out/%s-ios-%s-%s' % (build_type, tenv, arch)
-            gn_args = GN_IOS_ARGS % (str(debug).lower(), arch, tenv)
-            gn_cmd = 'gn gen %s %s' % (gn_out_dir, gn_args)
-            sh(gn_cmd, env)
-        for arch in MACOS_BUILD_ARCHS:
-            gn_out_dir = 'out/%s-macos-%s' % (build_type, arch)
-            gn_args = GN_MACOS_ARGS % (str(debug).lower(), arch)
-            gn_cmd = 'gn gen %s %s' % (gn_out_dir, gn_args)
-            sh(gn_cmd, env)
+        artifacts = ['WebRTC.xcframework.tgz', 'WebRTC.xcframework-bitcode.tgz']
+        gn_args_key = build_gn_args(GN_IOS_ARGS, extra_gn_args) + build_gn_args(GN_MACOS_ARGS, extra_gn_args)
     else:
-        for cpu in ANDROID_BUILD_CPUS:
-            gn_out_dir = 'out/%s-%s' % (build_type, cpu)
-            gn_args = GN_ANDROID_ARGS % (str(debug).lower(), cpu)
-            gn_cmd = 'gn gen %s %s' % (gn_out_dir, gn_args)
-            sh(gn_cmd, env)
+        artifacts = ['android-webrtc.tgz']
+        gn_args_key = build_gn_args(GN_ANDROID_ARGS, extra_gn_args)
+    artifact_cache_dir = None
+    if use_cache:
+        try:
+            git_head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=webrtc_dir).decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            git_head = None
+        if git_head:
+            key = hashlib.sha256('\0'.join([git_head, build_type, gn_args_key]).encode('utf-8')).hexdigest()[:16]
+            artifact_cache_dir = os.path.join(_cache_root(), 'artifacts', '%s-%s' % (platform, key))
+            if not clean and all(os.path.isfile(os.path.join(artifact_cache_dir, a)) for a in artifacts):
+                print('Using cached artifacts for %s (%s)' % (platform, key))
+                mkdirp(build_dir)
+                for artifact in artifacts:
+                    link_or_copy(os.path.join(artifact_cache_dir, artifact), build_dir)
+                os.utime(artifact_cache_dir)
+                return
+
+    # Run GN (each arch is independent, so run them all at once). args.gn is
+    # written directly into each out dir rather than passed as an --args
+    # string; the regen is skipped when the file and build graph are already
+    # in place (--reconfig forces it). If a skipped dir is somehow stale,
+    # ninja's generator rule re-runs gn itself when args.gn changes.
+    gn_cmds = []
+
+    def add_gn_cmd(gn_out_dir, gn_args):
+        args_gn_path = os.path.join(gn_out_dir, 'args.gn')
+        if not reconfig and os.path.isfile(os.path.join(gn_out_dir, 'build.ninja')) and os.path.isfile(args_gn_path):
+            with open(args_gn_path) as f:
+                if f.read() == gn_args:
+                    print('Skipping gn gen for %s, args unchanged (use --reconfig to override)' % gn_out_dir)
+                    return
+        mkdirp(gn_out_dir)
+        with open(args_gn_path, 'w') as f:
+            f.write(gn_args)
+        gn_cmds.append(['gn', 'gen', gn_out_dir])
 
-    # Build with Ninja
     if platform == 'ios':
         for item in IOS_BUILD_ARCHS:
             tenv, arch = item.split(':')
             gn_out_dir = 'out/%s-ios-%s-%s' % (build_type, tenv, arch)
-            ninja_cmd = 'ninja -C %s framework_objc' % gn_out_dir
-            sh(ninja_cmd, env)
+            gn_args = build_gn_args(GN_IOS_ARGS, extra_gn_args) % (str(debug).lower(), arch, tenv)
+            add_gn_cmd(gn_out_dir, gn_args)
         for arch in MACOS_BUILD_ARCHS:
             gn_out_dir = 'out/%s-macos-%s' % (build_type, arch)
-            ninja_cmd = 'ninja -C %s mac_framework_objc' % gn_out_dir
-            sh(ninja_cmd, env)
+            gn_args = build_gn_args(GN_MACOS_ARGS, extra_gn_args) % (str(debug).lower(), arch)
+            add_gn_cmd(gn_out_dir, gn_args)
     else:
         for cpu in ANDROID_BUILD_CPUS:
             gn_out_dir = 'out/%s-%s' % (build_type, cpu)
-            ninja_cmd = 'ninja -C %s libwebrtc libjingle_peerconnection_so' % gn_out_dir
-            sh(ninja_cmd, env)
+            gn_args = build_gn_args(GN_ANDROID_ARGS, extra_gn_args) % (str(debug).lower(), cpu)
+            add_gn_cmd(gn_out_dir, gn_args)
+    if gn_cmds:
+        sh_parallel(gn_cmds, env)
+
+    # Build with Ninja, overlapped with per-arch staging: as soon as an
+    # arch's ninja invocation finishes, its artifacts are staged (hardlinked
+    # .so files, bitcode-stripped framework shadows) while the remaining
+    # archs keep compiling. At most two ninja invocations overlap since
+    # ninja parallelizes internally; the 2x -j with a load cap lets the
+    # compile processes cover each other's I/O waits.
+    jobs = os.cpu_count() * 2
+    load = os.cpu_count() + 2
+    ninja = ['ninja', '-j', str(jobs), '-l', str(load), '-d', 'keepdepfile']
+    env['NINJA_STATUS'] = '[%f/%t %e] '
 
     # Cleanup build dir
     rmr(build_dir)
     mkdirp(build_dir)
 
-    # Copy build artifacts to build directory
     if platform == 'ios':
-        # Fat simulators (we need a single slice for both simulators)
         simulators = [item for item in IOS_BUILD_ARCHS if item.startswith('simulator')]
-        tenv, arch = simulators[0].split(':')
-        gn_out_dir = 'out/%s-ios-%s-%s' % (build_type, tenv, arch)
-        shutil.copytree(os.path.join(gn_out_dir, 'WebRTC.framework'), os.path.join(gn_out_dir, 'fat-WebRTC.framework'))
-        out_lib_path = os.path.join(gn_out_dir, 'fat-WebRTC.framework', 'WebRTC')
-        slice_paths = []
-        for item in simulators:
-            tenv, arch = item.split(':')
-            lib_path = os.path.join('out/%s-ios-%s-%s' % (build_type, tenv, arch), 'WebRTC.framework', 'WebRTC')
-            slice_paths.append(lib_path)
-        sh('lipo %s -create -output %s' % (' '.join(slice_paths), out_lib_path))
-
-        orig_framework_path = os.path.join(gn_out_dir, 'WebRTC.framework')
-        bak_framework_path = os.path.join(gn_out_dir, 'bak-WebRTC.framework')
-        fat_framework_path = os.path.join(gn_out_dir, 'fat-WebRTC.framework')
-        shutil.move(orig_framework_path, bak_framework_path)
-        shutil.move(fat_framework_path, orig_framework_path)
-
         _IOS_BUILD_ARCHS = [item for item in IOS_BUILD_ARCHS if not item.startswith('simulator')]
         _IOS_BUILD_ARCHS.append(simulators[0])
 
-        # XCFramework
-        xcframework_path = os.path.join(build_dir, 'WebRTC.xcframework')
-        xcodebuild_cmd = 'xcodebuild -create-xcframework -output %s' % xcframework_path
-        for item in _IOS_BUILD_ARCHS:
+        def bitcode_framework_path(item):
+            # The framework fed to the bitcode xcframework pass: ninja's own
+            # output for the device arch, the staged fat framework for the
+            # simulator entry
             tenv, arch = item.split(':')
             gn_out_dir = 'out/%s-ios-%s-%s' % (build_type, tenv, arch)
-            xcodebuild_cmd += ' -framework %s' % os.path.join(gn_out_dir, 'WebRTC.framework')
+            if item == simulators[0]:
+                return os.path.join(gn_out_dir, 'fat', 'WebRTC.framework')
+            return os.path.join(gn_out_dir, 'WebRTC.framework')
+
+        def stage_stripped_framework(framework_path, gn_out_dir):
+            # Bitcode-stripped shadow copy of the framework, so the bitcode
+            # and stripped xcframework passes run on disjoint inputs and
+            # nothing is mutated in place. The directory name inside the
+            # shadow tree must remain WebRTC.framework for xcodebuild's sake.
+            stripped_framework_path = os.path.join(gn_out_dir, 'stripped', 'WebRTC.framework')
+            rmr(stripped_framework_path)
+            mkdirp(os.path.dirname(stripped_framework_path))
+            sh_capture(['cp', '-Rl', framework_path, stripped_framework_path])
+            stripped_lib_path = os.path.join(stripped_framework_path, 'WebRTC')
+            os.unlink(stripped_lib_path)
+            sh_capture(['xcrun', 'bitcode_strip', '-r', os.path.join(framework_path, 'WebRTC'), '-o', stripped_lib_path])
+
+        def stage_fat_simulator_framework():
+            # Fat simulators (we need a single slice for both simulators),
+            # staged in a fat/ subdir so ninja's own output is never touched
+            # and stays trustworthy for incremental rebuilds
+            tenv, arch = simulators[0].split(':')
+            gn_out_dir = 'out/%s-ios-%s-%s' % (build_type, tenv, arch)
+            fat_framework_path = os.path.join(gn_out_dir, 'fat', 'WebRTC.framework')
+            rmr(fat_framework_path)
+            mkdirp(os.path.dirname(fat_framework_path))
+            # Hardlink the framework tree instead of copying hundreds of MB;
+            # only the WebRTC binary inside it gets replaced by lipo below
+            sh_capture(['cp', '-Rl', os.path.join(gn_out_dir, 'WebRTC.framework'), fat_framework_path])
+            out_lib_path = os.path.join(fat_framework_path, 'WebRTC')
+            # Break the hardlink so lipo writes a fresh file rather than
+            # mutating the original slice in WebRTC.framework
+            os.unlink(out_lib_path)
+            slice_paths = []
+            for item in simulators:
+                tenv, arch = item.split(':')
+                lib_path = os.path.join('out/%s-ios-%s-%s' % (build_type, tenv, arch), 'WebRTC.framework', 'WebRTC')
+                slice_paths.append(lib_path)
+            sh_capture(['lipo'] + slice_paths + ['-create', '-output', out_lib_path])
+            stage_stripped_framework(fat_framework_path, gn_out_dir)
+
+        # Repair out dirs written by older versions of this script, which
+        # swapped the fat framework into ninja's simulator output in place
+        # and left the thin slice parked in bak-WebRTC.framework
+        tenv, arch = simulators[0].split(':')
+        sim_out_dir = 'out/%s-ios-%s-%s' % (build_type, tenv, arch)
+        bak_framework_path = os.path.join(sim_out_dir, 'bak-WebRTC.framework')
+        if os.path.isdir(bak_framework_path):
+            rmr(os.path.join(sim_out_dir, 'WebRTC.framework'))
+            shutil.move(bak_framework_path, os.path.join(sim_out_dir, 'WebRTC.framework'))
+
+        built = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = {}
+            for item in IOS_BUILD_ARCHS:
+                tenv, arch = item.split(':')
+                gn_out_dir = 'out/%s-ios-%s-%s' % (build_type, tenv, arch)
+                futures[executor.submit(sh_capture, ninja + ['-C', gn_out_dir, 'framework_objc'], env)] = item
+            for arch in MACOS_BUILD_ARCHS:
+                gn_out_dir = 'out/%s-macos-%s' % (build_type, arch)
+                futures[executor.submit(sh_capture, ninja + ['-C', gn_out_dir, 'mac_framework_objc'], env)] = None
+            for future in concurrent.futures.as_completed(futures):
+                item = futures[future]
+                # The staging helpers run sh_capture too, so they share the
+                # build commands' failure handling
+                try:
+                    future.result()
+                    if item is None:
+                        # macOS frameworks carry no bitcode, nothing to stage
+                        continue
+                    built.add(item)
+                    if item.startswith('simulator'):
+                        # The fat simulator framework (and its stripped
+                        # shadow) needs both simulator slices
+                        if all(sim in built for sim in simulators):
+                            stage_fat_simulator_framework()
+                    else:
+                        tenv, arch = item.split(':')
+                        gn_out_dir = 'out/%s-ios-%s-%s' % (build_type, tenv, arch)
+                        stage_stripped_framework(os.path.join(gn_out_dir, 'WebRTC.framework'), gn_out_dir)
+                except subprocess.CalledProcessError as e:
+                    sys.exit(e.returncode)
+
+        # XCFramework (bitcode)
+        xcframework_path = os.path.join(build_dir, 'WebRTC.xcframework')
+        xcodebuild_cmd = ['xcodebuild', '-create-xcframework', '-output', xcframework_path]
+        for item in _IOS_BUILD_ARCHS:
+            xcodebuild_cmd += ['-framework', bitcode_framework_path(item)]
         for arch in MACOS_BUILD_ARCHS:
             gn_out_dir = 'out/%s-macos-%s' % (build_type, arch)
-            xcodebuild_cmd += ' -framework %s' % os.path.join(gn_out_dir, 'WebRTC.framework')
+            xcodebuild_cmd += ['-framework', os.path.join(gn_out_dir, 'WebRTC.framework')]
         sh(xcodebuild_cmd)
-        sh('tar zcf WebRTC.xcframework-bitcode.tgz WebRTC.xcframework', cwd=build_dir)
+        tar_czf('WebRTC.xcframework-bitcode.tgz', ['WebRTC.xcframework'], cwd=build_dir)
         rmr(xcframework_path)
 
         # XCFramework (stripped)
-        xcodebuild_cmd = 'xcodebuild -create-xcframework -output %s' % xcframework_path
-        bitcode_strip_cmd = 'xcrun bitcode_strip -r %s -o %s'
+        xcodebuild_cmd = ['xcodebuild', '-create-xcframework', '-output', xcframework_path]
         for item in _IOS_BUILD_ARCHS:
             tenv, arch = item.split(':')
             gn_out_dir = 'out/%s-ios-%s-%s' % (build_type, tenv, arch)
-            xcodebuild_cmd += ' -framework %s' % os.path.join(gn_out_dir, 'WebRTC.framework')
-            framework_path = os.path.join(gn_out_dir, 'WebRTC.framework', 'WebRTC')
-            sh(bitcode_strip_cmd % (framework_path, framework_path))
+            xcodebuild_cmd += ['-framework', os.path.join(gn_out_dir, 'stripped', 'WebRTC.framework')]
         for arch in MACOS_BUILD_ARCHS:
             gn_out_dir = 'out/%s-macos-%s' % (build_type, arch)
-            xcodebuild_cmd += ' -framework %s' % os.path.join(gn_out_dir, 'WebRTC.framework')
+            xcodebuild_cmd += ['-framework', os.path.join(gn_out_dir, 'WebRTC.framework')]
         sh(xcodebuild_cmd)
-        sh('tar zcf WebRTC.xcframework.tgz WebRTC.xcframework', cwd=build_dir)
+        tar_czf('WebRTC.xcframework.tgz', ['WebRTC.xcframework'], cwd=build_dir)
         rmr(xcframework_path)
     else:
-        gn_out_dir = 'out/%s-%s' % (build_type, ANDROID_BUILD_CPUS[0])
-        shutil.copy(os.path.join(gn_out_dir, 'lib.java/sdk/android/libwebrtc.jar'), build_dir)
-
-        for cpu in ANDROID_BUILD_CPUS:
-            lib_dir = os.path.join(build_dir, 'lib', ANDROID_CPU_ABI_MAP[cpu])
-            mkdirp(lib_dir)
-            gn_out_dir = 'out/%s-%s' % (build_type, cpu)
-            shutil.copy(os.path.join(gn_out_dir, 'libjingle_peerconnection_so.so'), lib_dir)
-
-        sh('jar cvfM libjingle_peerconnection.so.jar lib', cwd=build_dir)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = {}
+            for cpu in ANDROID_BUILD_CPUS:
+                gn_out_dir = 'out/%s-%s' % (build_type, cpu)
+                futures[executor.submit(sh_capture, ninja + ['-C', gn_out_dir, 'libwebrtc', 'libjingle_peerconnection_so'], env)] = cpu
+            for future in concurrent.futures.as_completed(futures):
+                cpu = futures[future]
+                try:
+                    future.result()
+                    # Stage this ABI's artifacts while the other ABIs keep
+                    # building
+                    gn_out_dir = 'out/%s-%s' % (build_type, cpu)
+                    lib_dir = os.path.join(build_dir, 'lib', ANDROID_CPU_ABI_MAP[cpu])
+                    mkdirp(lib_dir)
+                    link_or_copy(os.path.join(gn_out_dir, 'libjingle_peerconnection_so.so'), lib_dir)
+                    if cpu == ANDROID_BUILD_CPUS[0]:
+                        link_or_copy(os.path.join(gn_out_dir, 'lib.java/sdk/android/libwebrtc.jar'), build_dir)
+                except subprocess.CalledProcessError as e:
+                    sys.exit(e.returncode)
+
+        # Store-only zip: deflating the .so files here is wasted CPU since
+        # the outer tarball compresses them anyway (a jar is just a zip and
+        # cvfM wrote no manifest either)
+        sh(['zip', '-0', '-r', 'libjingle_peerconnection.so.jar', 'lib'], cwd=build_dir)
         rmr(os.path.join(build_dir, 'lib'))
-        sh('tar zcf android-webrtc.tgz *.jar', cwd=build_dir)
+        tar_czf('android-webrtc.tgz', ['*.jar'], cwd=build_dir)
+
+    # Populate the artifact cache for the next identical build
+    if artifact_cache_dir:
+        mkdirp(artifact_cache_dir)
+        for artifact in artifacts:
+            link_or_copy(os.path.join(build_dir, artifact), artifact_cache_dir)
+        _evict_artifact_cache()
 
 
 if __name__ == "__main__":
@@ -300,23 +616,32 @@ if __name__ == "__main__":
     parser.add_argument('--ios', help='Use iOS as the target platform', action='store_true')
     parser.add_argument('--android', help='Use Android as the target platform', action='store_true')
     parser.add_argument('--debug', help='Make a Debug build (defaults to false)', action='store_true')
+    parser.add_argument('--no-shallow', help='Fetch full git history during setup', action='store_true')
+    parser.add_argument('--no-cache', help='Bypass the shared depot_tools / WebRTC cache', action='store_true')
+    parser.add_argument('--clean', help='Delete the out directory and build from scratch', action='store_true')
+    parser.add_argument('--reconfig', help='Re-run gn gen but keep built object files', action='store_true')
+    parser.add_argument('--no-ccache', help='Do not wrap the compilers with sccache', action='store_true')
+    parser.add_argument('--force-sync', help='Run gclient sync even when DEPS is unchanged', action='store_true')
 
     args = parser.parse_args()
 
-    if not (args.setup or args.build or args.sync):
-        print('--setup or --build must be specified!')
+    # Exactly one mode and one platform; adding a new mode or platform is a
+    # one-line change to the relevant table
+    MODES = {
+        'setup': lambda target_dir, platform: setup(target_dir, platform, shallow=not args.no_shallow, use_cache=not args.no_cache, force_sync=args.force_sync),
+        'build': lambda target_dir, platform: build(target_dir, platform, args.debug, clean=args.clean, reconfig=args.reconfig, use_ccache=not args.no_ccache, use_cache=not args.no_cache),
+        'sync' : lambda target_dir, platform: sync(target_dir, platform, force_sync=args.force_sync)
+    }
+    PLATFORMS = ['ios', 'android']
+
+    selected_modes = [m for m in MODES if getattr(args, m)]
+    if len(selected_modes) != 1:
+        print('Exactly one of %s must be specified!' % ' / '.join('--%s' % m for m in MODES))
         sys.exit(1)
 
-    if args.setup and args.build:
-        print('--setup and --build cannot be specified at the same time!')
-        sys.exit(1)
-
-    if not (args.ios or args.android):
-        print('--ios or --android must be specified!')
-        sys.exit(1)
-
-    if args.ios and args.android:
-        print('--ios and --android cannot be specified at the same time!')
+    selected_platforms = [p for p in PLATFORMS if getattr(args, p)]
+    if len(selected_platforms) != 1:
+        print('Exactly one of %s must be specified!' % ' / '.join('--%s' % p for p in PLATFORMS))
         sys.exit(1)
 
     if not os.path.isdir(args.dir):
@@ -324,19 +649,8 @@ if __name__ == "__main__":
         sys.exit(1)
 
     target_dir = os.path.abspath(os.path.join(args.dir, 'build_webrtc'))
-    platform = 'ios' if args.ios else 'android'
-
-    if args.setup:
-        setup(target_dir, platform)
-        print('WebRTC setup for %s completed in %s' % (platform, target_dir))
-        sys.exit(0)
-
-    if args.sync:
-        sync(target_dir, platform)
-        print('WebRTC sync for %s completed in %s' % (platform, target_dir))
-        sys.exit(0)
-
-    if args.build:
-        build(target_dir, platform, args.debug)
-        print('WebRTC build for %s completed in %s' % (platform, target_dir))
-        sys.exit(0)
+    mode = selected_modes[0]
+    platform = selected_platforms[0]
+
+    MODES[mode](target_dir, platform)
+    print('WebRTC %s for %s completed in %s' % (mode, platform, target_dir))